@@ -20,15 +20,30 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import json
+import libvirt
 import magic
 import os
+import re
+import stat
 import subprocess
+import thread
+import threading
 import xmpp
 
+from contextlib import contextmanager
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
 from archipelcore.archipelPlugin import TNArchipelPlugin
 from archipel.archipelVirtualMachine import ARCHIPEL_ERROR_CODE_VM_MIGRATING
 from archipelcore.utils import build_error_iq
 
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
 
 ARCHIPEL_NS_VM_DISK                     = "archipel:vm:disk"
 ARCHIPEL_ERROR_CODE_DRIVES_CREATE       = -3001
@@ -39,6 +54,34 @@ ARCHIPEL_ERROR_CODE_DRIVES_CONVERT      = -3005
 ARCHIPEL_ERROR_CODE_DRIVES_RENAME       = -3006
 ARCHIPEL_ERROR_CODE_DRIVES_GETGOLDEN    = -3007
 
+ARCHIPEL_STORAGE_MAX_PROBING_THREADS    = 16
+ARCHIPEL_STORAGE_MAX_DELETION_THREADS   = 2
+ARCHIPEL_STORAGE_UNITS                  = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+# (offset, signature, format) of the drive headers, checked in this order
+ARCHIPEL_STORAGE_DRIVE_SIGNATURES       = ((0, "OOOM", "cow"),
+                                           (0, "QFI\xfb\x00\x00\x00\x01", "qcow"),
+                                           (0, "QFI\xfb", "qcow2"),
+                                           (0, "KDMV", "vmdk"),
+                                           (0, "COWD", "vmdk"),
+                                           (0x8001, "CD001", "iso"),
+                                           (510, "\x55\xaa", "raw"))
+ARCHIPEL_STORAGE_DRIVE_HEADER_SIZE      = max([offset + len(signature) for offset, signature, format in ARCHIPEL_STORAGE_DRIVE_SIGNATURES])
+ARCHIPEL_STORAGE_RAW_MAGICS             = ("filesystem data", )
+ARCHIPEL_STORAGE_DRIVE_EXTENSIONS       = frozenset(["cow", "qcow", "qcow2", "img", "raw", "vmdk", "vdi", "vhd", "vhdx"])
+ARCHIPEL_STORAGE_NON_DRIVE_EXTENSIONS   = frozenset(["conf", "db", "json", "log", "pid", "sqlite", "sqlite3", "txt", "xml"])
+ARCHIPEL_STORAGE_UNSAFE_NAME_REGEX      = re.compile(r"[ /\x00]|\.\.")
+
+# a single inotify instance and notifier thread are shared by all the virtual
+# machines of the agent. _folder_watches maps each watched folder to its watch
+# descriptor (-1 if not watched) and number of users, _folder_versions to its
+# listing version
+_folder_watch_lock                      = threading.Lock()
+_folder_watch_manager                   = None
+_folder_notifier                        = None
+_folder_watches                         = {}
+_folder_versions                        = {}
+
 
 class TNStorageManagement (TNArchipelPlugin):
     """
@@ -62,6 +105,10 @@ class TNStorageManagement (TNArchipelPlugin):
             self.qemu_img_bin = self.configuration.get("STORAGE", "qemu_img_bin_path")
         else:
             self.qemu_img_bin = "qemu-img"
+        if self.configuration.has_option("STORAGE", "qemu_img_convert_coroutines"):
+            self.qemu_img_convert_coroutines = self.configuration.getint("STORAGE", "qemu_img_convert_coroutines")
+        else:
+            self.qemu_img_convert_coroutines = None
         if not os.path.exists(self.qemu_img_bin):
             raise Exception("qemu-img is not found at path %s. You may need to install it" % self.qemu_img_bin)
         if not os.path.exists(self.shared_isos_folder):
@@ -69,6 +116,19 @@ class TNStorageManagement (TNArchipelPlugin):
         if not os.path.exists(self.golden_drives_dir):
             os.makedirs(self.golden_drives_dir)
         self.magicObject = magic.Magic()
+        self.magicLock = threading.Lock()
+        self._disk_cache = {}
+        self._iso_cache = {}
+        self._busy_depth = 0
+        self._busy_lock = threading.Lock()
+        # paths of the drives being created or converted
+        self._pending_paths = set()
+        self._pending_paths_lock = threading.Lock()
+        # folder listings, kept up to date by inotify when pyinotify is available
+        self._folder_listings = {}
+        self._watched_folders = []
+        if pyinotify:
+            self.start_folder_notifier()
         # permissions
         self.entity.permission_center.create_permission("drives_create", "Authorizes user to get create a drive", False)
         self.entity.permission_center.create_permission("drives_delete", "Authorizes user to delete a drive", False)
@@ -76,6 +136,8 @@ class TNStorageManagement (TNArchipelPlugin):
         self.entity.permission_center.create_permission("drives_getiso", "Authorizes user to get existing ISO images", False)
         self.entity.permission_center.create_permission("drives_convert", "Authorizes user to convert a drive", False)
         self.entity.permission_center.create_permission("drives_rename", "Authorizes user to rename a drive", False)
+        # hooks
+        self.entity.register_hook("HOOK_VM_TERMINATE", method=self.vm_terminate)
 
 
     ### Plugin interface
@@ -111,66 +173,461 @@ class TNStorageManagement (TNArchipelPlugin):
                     "configuration-tokens"      : plugin_configuration_tokens }
 
 
-    ### Utilities
+    ### Hooks
+
+    def vm_terminate(self, origin, user_info, arguments):
+        """
+        Stop watching the folders.
+        @type origin: TNArchipelEntity
+        @param origin: the origin of the hook
+        @type user_info: object
+        @param user_info: random user information
+        @type arguments: object
+        @param arguments: runtime argument
+        """
+        if pyinotify:
+            self.stop_folder_notifier()
+
+
+    ### Folder watching
+
+    def start_folder_notifier(self):
+        """
+        Watch the virtual machine folder and the shared ISO folder with inotify
+        in order to reuse their listing until a file is added, removed or renamed.
+        If inotify can't be used, the folders are listed on each request.
+        """
+        global _folder_watch_manager, _folder_notifier
+        mask = pyinotify.IN_CREATE | pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO
+        with _folder_watch_lock:
+            try:
+                if not _folder_notifier:
+                    watch_manager = pyinotify.WatchManager()
+                    notifier = pyinotify.ThreadedNotifier(watch_manager, default_proc_fun=self.on_folder_event)
+                    notifier.daemon = True
+                    notifier.start()
+                    _folder_watch_manager, _folder_notifier = watch_manager, notifier
+                for folder in (self.entity.folder, self.shared_isos_folder):
+                    folder = os.path.normpath(folder)
+                    watch = _folder_watches.setdefault(folder, [-1, 0])
+                    watch[1] += 1
+                    self._watched_folders.append(folder)
+                    if watch[0] < 0:
+                        watch[0] = _folder_watch_manager.add_watch(folder, mask).get(folder, -1)
+                        if watch[0] >= 0:
+                            _folder_versions[folder] = 0
+            except Exception as ex:
+                self.entity.log.warning("STORAGE: unable to watch folders with inotify, they will be listed on each request: %s" % str(ex))
+
+    def stop_folder_notifier(self):
+        """
+        Release the watches of the folders and stop the notifier once
+        no virtual machine uses it anymore.
+        """
+        global _folder_watch_manager, _folder_notifier
+        with _folder_watch_lock:
+            for folder in self._watched_folders:
+                _folder_watches[folder][1] -= 1
+                if not _folder_watches[folder][1]:
+                    if _folder_watches[folder][0] >= 0:
+                        _folder_watch_manager.rm_watch(_folder_watches[folder][0])
+                    del _folder_watches[folder]
+                    _folder_versions.pop(folder, None)
+            self._watched_folders = []
+            self._folder_listings = {}
+            notifier = None
+            if _folder_notifier and not _folder_watches:
+                notifier = _folder_notifier
+                _folder_watch_manager, _folder_notifier = None, None
+        # stopped outside of the lock, as it waits for the event being processed
+        if notifier:
+            notifier.stop()
 
-    def _is_file_a_drive(self, path):
+    @staticmethod
+    def on_folder_event(event):
         """
-        check if given drive is a valid virtual drive
-        @type path: string
-        @param path: the path of the file to check
+        Invalidate the listing of the folder in which the event occured.
+        @type event: pyinotify.Event
+        @param event: the inotify event
         """
-        return self._is_file_a_cow(path) \
-        or self._is_file_a_qcow(path) \
-        or self._is_file_a_qcow2(path) \
-        or self._is_file_a_raw(path) \
-        or self._is_file_a_vmdk(path) \
-        or self._is_file_an_iso(path)
+        with _folder_watch_lock:
+            if event.mask & pyinotify.IN_Q_OVERFLOW:
+                folders = _folder_versions.keys()
+            else:
+                folders = [os.path.normpath(event.path)]
+            for folder in folders:
+                if event.mask & pyinotify.IN_IGNORED:
+                    # the folder has been removed, list it on each request from now on
+                    if folder in _folder_watches and _folder_watches[folder][0] == event.wd:
+                        _folder_watches[folder][0] = -1
+                        _folder_versions.pop(folder, None)
+                elif folder in _folder_versions:
+                    _folder_versions[folder] += 1
+
 
-    def _is_file_a_cow(self, path):
+    ### Utilities
+
+    def _list_folder(self, folder):
+        """
+        list the names of the entries of given folder. The listing of
+        a watched folder is reused until an inotify event invalidates it.
+        @type folder: string
+        @param folder: the folder to list
+        @rtype: list
+        @return: the names of the entries
+        """
+        folder = os.path.normpath(folder)
+        version = _folder_versions.get(folder)
+        if version is None:
+            return os.listdir(folder)
+        listing = self._folder_listings.get(folder)
+        if listing and listing[0] == version:
+            return listing[1]
+        names = os.listdir(folder)
+        self._folder_listings[folder] = (version, names)
+        return names
+
+    def _invalidate_folder(self, folder):
+        """
+        make the next listing of given folder read it again, to be
+        called right after the plugin changed its content
+        @type folder: string
+        @param folder: the changed folder
+        """
+        folder = os.path.normpath(folder)
+        with _folder_watch_lock:
+            if folder in _folder_versions:
+                _folder_versions[folder] += 1
+
+    def _list_files(self, folder):
+        """
+        list the regular files of the given folder
+        @type folder: string
+        @param folder: the folder to list
+        @rtype: list
+        @return: list of tuples (name, path, stat result)
+        """
+        files = []
+        for name in self._list_folder(folder):
+            path = os.path.join(folder, name)
+            try:
+                file_stat = os.stat(path)
+            except OSError:
+                continue
+            if stat.S_ISREG(file_stat.st_mode):
+                files.append((name, path, file_stat))
+        return files
+
+    def _get_header_format(self, path):
+        """
+        identify the drive format of given file from the signature in its header
+        @type path: string
+        @param path: the path of the file to check
+        @rtype: string
+        @return: cow, qcow, qcow2, raw, vmdk, iso or None if no signature matches
         """
-        check if given drive is a valid COW file
+        try:
+            with open(path, "rb") as f:
+                header = f.read(ARCHIPEL_STORAGE_DRIVE_HEADER_SIZE)
+        except IOError:
+            return None
+        for offset, signature, format in ARCHIPEL_STORAGE_DRIVE_SIGNATURES:
+            if header.startswith(signature, offset):
+                return format
+        return None
+
+    def _get_file_format(self, path):
+        """
+        identify the drive format of given file by reading its header.
+        libmagic is only asked for files without any known signature,
+        in order to recognize raw drives.
         @type path: string
         @param path: the path of the file to check
+        @rtype: string
+        @return: cow, qcow, qcow2, raw, vmdk, iso or None if file is not a drive
+        """
+        format = self._get_header_format(path)
+        if format:
+            return format
+        with self.magicLock:
+            output = self.magicObject.from_file(path)
+        if output == "data" or any(m in output for m in ARCHIPEL_STORAGE_RAW_MAGICS):
+            return "raw"
+        return None
+
+    def _map_in_threads(self, function, items, max_threads):
+        """
+        run the given function on each item using a pool of threads
+        @type function: function
+        @param function: the function to run for each item
+        @type items: list
+        @param items: the items to process
+        @type max_threads: integer
+        @param max_threads: the maximum number of threads to use
+        @rtype: list
+        @return: the results of the function, in the same order than items
+        """
+        if not items:
+            return []
+        pool = ThreadPool(min(max_threads, len(items)))
+        try:
+            return pool.map(function, items)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _probe_folders(self, folders, probe, cache):
+        """
+        run the given probe on the regular files of given folders in a single
+        pass. Results of files that have not changed since the previous call
+        are reused.
+        @type folders: list
+        @param folders: the folders to probe
+        @type probe: function
+        @param probe: the function to run for each file
+        @type cache: dict
+        @param cache: the cache to use, indexed by folder
+        @rtype: list
+        @return: the results of the probe for each file of the folders
+        """
+        files = []
+        files_to_probe = []
+        for folder in folders:
+            previous = cache.get(folder, {})
+            current = {}
+            for file_info in self._list_files(folder):
+                name, path, file_stat = file_info
+                if path in previous and previous[path][0] == (file_stat.st_mtime, file_stat.st_size):
+                    current[path] = previous[path]
+                else:
+                    files_to_probe.append((folder, file_info))
+                files.append((folder, path))
+            cache[folder] = current
+        for (folder, file_info), result in zip(files_to_probe, self._map_in_threads(probe, [file_info for folder, file_info in files_to_probe], ARCHIPEL_STORAGE_MAX_PROBING_THREADS)):
+            name, path, file_stat = file_info
+            cache[folder][path] = ((file_stat.st_mtime, file_stat.st_size), result)
+        return [cache[folder][path][1] for folder, path in files]
+
+    def _probe_drive(self, file_info):
+        """
+        probe given file and build the attributes of its disk node
+        @type file_info: tuple
+        @param file_info: tuple (name, path, stat result)
+        @rtype: dict
+        @return: the attributes of the disk node or None if file is not a drive
+        """
+        disk, diskPath, diskStat = file_info
+        extension = os.path.splitext(disk)[1][1:].lower()
+        if extension in ARCHIPEL_STORAGE_NON_DRIVE_EXTENSIONS:
+            return None
+        if not extension in ARCHIPEL_STORAGE_DRIVE_EXTENSIONS and not self._is_file_a_drive(diskPath):
+            return None
+        diskInfo = self._get_drive_info(diskPath)
+        if not diskInfo:
+            return None
+        currentAttributes = {
+            "name": os.path.basename(os.path.splitext(disk)[0]),
+            "path": diskPath,
+            "format": diskInfo["format"],
+            "virtualSize": diskInfo["virtual-size"],
+            "diskSize": diskStat.st_size
+        }
+        if "backing-filename" in diskInfo:
+            currentAttributes["backingFile"] = os.path.basename(diskInfo["backing-filename"])
+        return currentAttributes
+
+    def _probe_iso(self, file_info):
+        """
+        probe given file and build the attributes of its iso node
+        @type file_info: tuple
+        @param file_info: tuple (name, path, stat result)
+        @rtype: dict
+        @return: the attributes of the iso node or None if file is not an ISO
         """
-        m = magic.Magic()
-        output = m.from_file(path).lower()
-        return "user-mode linux cow file" in output
+        iso, isoPath, isoStat = file_info
+        if not self._is_file_an_iso(isoPath):
+            return None
+        return {"name": iso, "path": isoPath}
 
-    def _is_file_a_qcow(self, path):
+    def _get_drive_info(self, path):
         """
-        check if given drive is a valid QCOW file
+        get the information qemu-img has about given drive
         @type path: string
-        @param path: the path of the file to check
+        @param path: the path of the drive
+        @rtype: dict
+        @return: the decoded JSON output of qemu-img info or None if qemu-img can't read the drive
+        """
+        process = subprocess.Popen([self.qemu_img_bin, "info", "--output=json", path], stdout=subprocess.PIPE)
+        output = process.communicate()[0]
+        if not process.returncode == 0:
+            return None
+        return json.loads(output)
+
+    @contextmanager
+    def _busy(self, status):
+        """
+        set the entity presence to dnd with given status while the block runs.
+        When operations overlap, only the first one changes the presence and
+        only the last one restores it.
+        @type status: string
+        @param status: the presence status to use while busy
+        """
+        with self._busy_lock:
+            self._busy_depth += 1
+            if self._busy_depth == 1:
+                self._busy_old_show = self.entity.xmppstatusshow
+                self._busy_old_status = self.entity.xmppstatus
+                self.entity.change_presence(presence_show="dnd", presence_status=status)
+        try:
+            yield
+        finally:
+            with self._busy_lock:
+                self._busy_depth -= 1
+                if self._busy_depth == 0:
+                    self.entity.change_presence(presence_show=self._busy_old_show, presence_status=self._busy_old_status)
+
+    def _reserve_paths(self, paths, new_paths):
+        """
+        mark the paths of a drive job as in use until _release_paths is called
+        @type paths: list
+        @param paths: the paths of the existing drives used by the job
+        @type new_paths: list
+        @param new_paths: the paths of the drives the job will write, that must not exist
+        @raise Exception: if a path is used by another job or a new path already exists
+        """
+        with self._pending_paths_lock:
+            for path in paths + new_paths:
+                if path in self._pending_paths:
+                    raise Exception("The disk %s is already being processed." % os.path.basename(path))
+            for path in new_paths:
+                if os.path.exists(path):
+                    raise Exception("The disk %s already exists." % os.path.basename(path))
+            self._pending_paths.update(paths + new_paths)
+
+    def _release_paths(self, paths):
+        """
+        mark the paths reserved by a drive job as free again
+        @type paths: list
+        @param paths: the paths to release
+        """
+        with self._pending_paths_lock:
+            self._pending_paths.difference_update(paths)
+
+    def _create_raw_drive(self, path, size, unit):
+        """
+        create a sparse raw drive, like qemu-img create -f raw does
+        @type path: string
+        @param path: the path of the new drive
+        @type size: string
+        @param size: the size of the new drive
+        @type unit: string
+        @param unit: the unit of the size (K, M, G or T)
+        """
+        size_in_bytes = int(float(size) * ARCHIPEL_STORAGE_UNITS[unit])
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        try:
+            os.ftruncate(fd, size_in_bytes)
+        finally:
+            os.close(fd)
+
+    def _prepare_drive_creation(self, disk_node):
         """
-        output = self.magicObject.from_file(path).lower()
-        return "format: qcow , version: 1" in output or "qemu qcow image (v1)" in output
+        check the parameters of a drive to create and build its creation info
+        @type disk_node: xmpp.Node
+        @param disk_node: the node holding the drive attributes
+        @rtype: dict
+        @return: the creation info, with command set to None for raw drives
+        """
+        disk_name     = ARCHIPEL_STORAGE_UNSAFE_NAME_REGEX.sub("_", disk_node.getAttr("name"))
+        disk_size     = disk_node.getAttr("size")
+        disk_unit     = disk_node.getAttr("unit")
+        format        = disk_node.getAttr("format")
+        prealloc      = disk_node.getAttr("preallocation")
+        golden        = disk_node.getAttr("golden")
+        disk_path     = os.path.join(self.entity.folder, "%s.%s" % (disk_name, format))
+        if disk_unit == "M" and (float(disk_size) >= 1000000000):
+            raise Exception("too big", "You may be able to do it manually, but I won't try.")
+        elif disk_unit == "G" and (float(disk_size) >= 10000):
+            raise Exception("too big", "You may be able to do it manually, but I won't try.")
+
+        if prealloc and prealloc == "metadata" and format == "qcow2" and self.entity.configuration.getboolean("STORAGE", "use_metadata_preallocation"):
+            self.entity.log.info("Creating a QCOW2 file with preallocated metadata.")
+            command = [self.qemu_img_bin, "create", "-f", format, "-o", "preallocation=metadata", disk_path, "%s%s" % (disk_size, disk_unit)]
+        elif golden and format == "qcow2":
+            self.entity.log.info("Creating a differencing QCOW2 file with backing file.")
+            if not os.path.exists(os.path.join(self.golden_drives_dir, golden)):
+                raise Exception("The requested golden image %s has not been found in the golden folder. Cannot create drive")
+            else:
+                command = [self.qemu_img_bin, "create", "-f", format, "-b", "%s/%s" % (self.golden_drives_dir, golden), disk_path, "%s%s" % (disk_size, disk_unit)]
+        elif format == "raw":
+            command = None
+        else:
+            command = [self.qemu_img_bin, "create", "-f", format, disk_path, "%s%s" % (disk_size, disk_unit)]
+        return {"command": command, "path": disk_path, "name": disk_name, "size": disk_size, "unit": disk_unit}
 
-    def _is_file_a_qcow2(self, path):
+    def _create_drive(self, creation):
         """
-        check if given drive is a valid QCOW2 file
-        @type path: string
-        @param path: the path of the file to check
+        create a drive from its creation info
+        @type creation: dict
+        @param creation: the creation info as returned by _prepare_drive_creation
+        @rtype: Exception
+        @return: the error that occured or None
         """
-        output = self.magicObject.from_file(path).lower()
-        return "format: qcow , version: 2" in output or "qemu qcow image (v2)" in output
+        try:
+            if creation["command"]:
+                ret = subprocess.call(creation["command"])
+                if not ret == 0:
+                    raise Exception("DriveError", "Unable to create drive. Error code is " + str(ret))
+            else:
+                self._create_raw_drive(creation["path"], creation["size"], creation["unit"])
+        except Exception as ex:
+            return ex
+        return None
 
-    def _is_file_a_raw(self, path):
+    def _delete_drive(self, path):
         """
-        check if given drive is a valid RAW drive
+        remove a drive file
         @type path: string
-        @param path: the path of the file to check
+        @param path: the path of the drive to remove
+        @rtype: Exception
+        @return: the error that occured or None
         """
-        output = self.magicObject.from_file(path).lower()
-        return output == "data" or "x86 boot sector" in output or "filesystem data" in output
+        try:
+            os.unlink(path)
+        except Exception as ex:
+            return ex
+        return None
+
+    def _detach_drives(self, paths):
+        """
+        remove the drives with given paths from the definition of the virtual machine
+        @type paths: list
+        @param paths: the paths of the drives to remove
+        @rtype: boolean
+        @return: True if at least one drive has been removed
+        """
+        if not self.entity.definition:
+            return False
+        detached = False
+        devices_node = self.entity.definition.getTag('devices')
+        for disk_node in devices_node.getTags('disk', attrs={'type': 'file'}):
+            if disk_node.getTag('source').getAttr('file') in paths:
+                # an undefined domain only keeps its local definition
+                if self.entity.domain:
+                    # serialized while still attached, the node shares the namespace of
+                    # its parent so no undeclared xmlns is added to it
+                    self.entity.domain.detachDeviceFlags(str(disk_node), libvirt.VIR_DOMAIN_AFFECT_CONFIG)
+                devices_node.delChild(disk_node)
+                detached = True
+        return detached
 
-    def _is_file_a_vmdk(self, path):
+    def _is_file_a_drive(self, path):
         """
-        check if given drive is a valid VMDK
+        check if given drive is a valid virtual drive
         @type path: string
         @param path: the path of the file to check
         """
-        output = self.magicObject.from_file(path).lower()
-        return "vmware" in output
+        return self._get_file_format(path) is not None
 
     def _is_file_an_iso(self, path):
         """
@@ -178,8 +635,123 @@ class TNStorageManagement (TNArchipelPlugin):
         @type path: string
         @param path: the path of the file to check
         """
-        output = self.magicObject.from_file(path).lower()
-        return "iso 9660" in output
+        return self._get_header_format(path) == "iso"
+
+
+    ### Threaded operations
+
+    def perform_threaded_creation(self, iq, creations):
+        """
+        Create drives concurrently and reply to the IQ once done.
+        @type iq: xmpp.Protocol.Iq
+        @param iq: the received IQ
+        @type creations: list
+        @param creations: the creation infos as returned by _prepare_drive_creation
+        """
+        errors = []
+        results = self._map_in_threads(self._create_drive, creations, cpu_count())
+        self._release_paths([creation["path"] for creation in creations])
+        self._invalidate_folder(self.entity.folder)
+        for creation, error in zip(creations, results):
+            if error:
+                self.entity.shout("disk", "I can't create hard drive %s: %s" % (creation["name"], str(error)))
+                errors.append("%s: %s" % (creation["name"], str(error)))
+            else:
+                self.entity.log.info("disk %s created" % creation["path"])
+                self.entity.shout("disk", "I've just created a new hard drive named %s with size of %s%s." % (creation["name"], creation["size"], creation["unit"]))
+        if len(errors) < len(creations):
+            self.entity.push_change("disk", "created")
+        if errors:
+            reply = build_error_iq(self, Exception("Unable to create drive %s" % ", ".join(errors)), iq, ARCHIPEL_ERROR_CODE_DRIVES_CREATE)
+        else:
+            reply = iq.buildReply("result")
+        self.entity.xmppclient.send(reply)
+
+    def perform_threaded_conversion(self, iq, path, format, disk_path):
+        """
+        Run qemu-img convert, update the definition and reply to the IQ once done.
+        @type iq: xmpp.Protocol.Iq
+        @param iq: the received IQ
+        @type path: string
+        @param path: the path of the drive to convert
+        @type format: string
+        @param format: the target format
+        @type disk_path: string
+        @param disk_path: the path of the converted drive
+        """
+        try:
+            with self._busy("Converting a disk..."):
+                drive_info = self._get_drive_info(path)
+                if drive_info and drive_info["format"] == format:
+                    # drive is already in the target format, only its extension changes
+                    os.rename(path, disk_path)
+                else:
+                    command = [self.qemu_img_bin, "convert"]
+                    if self.qemu_img_convert_coroutines:
+                        command.extend(["-W", "-m", str(self.qemu_img_convert_coroutines)])
+                    command.extend([path, "-O", format, disk_path])
+                    ret = subprocess.call(command)
+                    if not ret == 0:
+                        raise Exception("DriveError", "Unable to convert drive. Error code is " + str(ret))
+                    os.unlink(path)
+                self._invalidate_folder(os.path.dirname(disk_path))
+                for drive in self.entity.definition.getTag("devices").getTags("disk"):
+                    source = drive.getTag("source")
+                    if not source or not source.getAttr("file") == path:
+                        continue
+                    driver = drive.getTag("driver")
+                    if driver:
+                        driver.setAttr("type", format)
+                    source.setAttr("file", disk_path)
+                    self.entity.define(self.entity.definition)
+                    break
+            self.entity.log.info("Disk as been converted from %s to %s" % (path, disk_path))
+            self.entity.shout("disk", "I've just converted hard drive %s into format %s." % (path, format))
+            self.entity.push_change("disk", "converted")
+            reply = iq.buildReply("result")
+        except Exception as ex:
+            self.entity.shout("disk", "I can't convert hard drive %s: %s" % (path, str(ex)))
+            reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_DRIVES_CONVERT)
+        finally:
+            self._release_paths([path, disk_path])
+        self.entity.xmppclient.send(reply)
+
+    def perform_threaded_deletion(self, iq, deletions, undefine):
+        """
+        Remove drive files concurrently and reply to the IQ once done.
+        @type iq: xmpp.Protocol.Iq
+        @param iq: the received IQ
+        @type deletions: list
+        @param deletions: list of tuples (path, name) of the drives to remove
+        @type undefine: boolean
+        @param undefine: if True, also remove the deleted drives from the definition
+        """
+        with self._busy("Deleting a drive..."):
+            results = self._map_in_threads(self._delete_drive, [path for path, name in deletions], ARCHIPEL_STORAGE_MAX_DELETION_THREADS)
+        self._invalidate_folder(self.entity.folder)
+        errors = []
+        deleted_paths = []
+        for (disk_path, disk_name), error in zip(deletions, results):
+            if error:
+                self.entity.shout("disk", "I can't delete hard drive %s: %s" % (disk_name, str(error)))
+                errors.append("%s: %s" % (disk_name, str(error)))
+            else:
+                deleted_paths.append(disk_path)
+                self.entity.log.info("disk %s deleted" % disk_path)
+                self.entity.shout("disk", "I've just deleted the hard drive named %s." % (disk_name))
+        if undefine and deleted_paths:
+            try:
+                if self._detach_drives(deleted_paths):
+                    self.entity.push_change("virtualmachine:definition", "defined")
+            except Exception as ex:
+                errors.append("definition: %s" % str(ex))
+        if deleted_paths:
+            self.entity.push_change("disk", "deleted")
+        if errors:
+            reply = build_error_iq(self, Exception("Unable to delete drive %s" % ", ".join(errors)), iq, ARCHIPEL_ERROR_CODE_DRIVES_DELETE)
+        else:
+            reply = iq.buildReply("result")
+        self.entity.xmppclient.send(reply)
 
 
     ### XMPP Processing
@@ -223,48 +795,30 @@ class TNStorageManagement (TNArchipelPlugin):
         if reply:
             conn.send(reply)
             raise xmpp.protocol.NodeProcessed
+        elif action in ("create", "delete", "convert"):
+            # the worker thread replies once the job is done
+            raise xmpp.protocol.NodeProcessed
 
     def iq_create(self, iq):
         """
-        Create a disk in given format.
+        Create a disk in given format. Several disks can be created at
+        once by giving one <disk> child per disk to the archipel node.
         @type iq: xmpp.Protocol.Iq
         @param iq: the received IQ
         @rtype: xmpp.Protocol.Iq
-        @return: a ready to send IQ containing the result of the action
+        @return: an IQ containing the error if any, None if the job thread replies
         """
         try:
-            query_node  = iq.getTag("query")
-            disk_name   = query_node.getTag("archipel").getAttr("name").replace(" ", "_").replace("/", "_").replace("..", "_")
-            disk_size   = query_node.getTag("archipel").getAttr("size")
-            disk_unit   = query_node.getTag("archipel").getAttr("unit")
-            format      = query_node.getTag("archipel").getAttr("format")
-            prealloc    = query_node.getTag("archipel").getAttr("preallocation")
-            golden      = query_node.getTag("archipel").getAttr("golden")
-            disk_path   = os.path.join(self.entity.folder, "%s.%s" % (disk_name, format))
-            if disk_unit == "M" and (float(disk_size) >= 1000000000):
-                raise Exception("too big", "You may be able to do it manually, but I won't try.")
-            elif disk_unit == "G" and (float(disk_size) >= 10000):
-                raise Exception("too big", "You may be able to do it manually, but I won't try.")
-            if os.path.exists(disk_path):
-                raise Exception("The disk with name %s already exists." % disk_name)
-
-            if prealloc and prealloc == "metadata" and format == "qcow2" and self.entity.configuration.getboolean("STORAGE", "use_metadata_preallocation"):
-                self.entity.log.info("Creating a QCOW2 file with preallocated metadata.")
-                ret = subprocess.call([self.qemu_img_bin, "create", "-f", format, "-o", "preallocation=metadata", disk_path, "%s%s" % (disk_size, disk_unit)])
-            elif golden and format == "qcow2":
-                self.entity.log.info("Creating a differencing QCOW2 file with backing file.")
-                if not os.path.exists(os.path.join(self.golden_drives_dir, golden)):
-                    raise Exception("The requested golden image %s has not been found in the golden folder. Cannot create drive")
-                else:
-                    ret = subprocess.call([self.qemu_img_bin, "create", "-f", format, "-b", "%s/%s" % (self.golden_drives_dir, golden), disk_path, "%s%s" % (disk_size, disk_unit)])
-            else:
-                ret = subprocess.call([self.qemu_img_bin, "create", "-f", format, disk_path, "%s%s" % (disk_size, disk_unit)])
-            if not ret == 0:
-                raise Exception("DriveError", "Unable to create drive. Error code is " + str(ret))
-            reply = iq.buildReply("result")
-            self.entity.log.info("disk created")
-            self.entity.shout("disk", "I've just created a new hard drive named %s with size of %s%s." % (disk_name, disk_size, disk_unit))
-            self.entity.push_change("disk", "created")
+            archipel_node = iq.getTag("query").getTag("archipel")
+            creations = []
+            for disk_node in archipel_node.getTags("disk") or [archipel_node]:
+                creation = self._prepare_drive_creation(disk_node)
+                if creation["path"] in [c["path"] for c in creations]:
+                    raise Exception("The disk with name %s is requested more than once." % creation["name"])
+                creations.append(creation)
+            self._reserve_paths([], [creation["path"] for creation in creations])
+            thread.start_new_thread(self.perform_threaded_creation, (iq, creations))
+            reply = None
         except Exception as ex:
             reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_DRIVES_CREATE)
         return reply
@@ -275,38 +829,17 @@ class TNStorageManagement (TNArchipelPlugin):
         @type iq: xmpp.Protocol.Iq
         @param iq: the received IQ
         @rtype: xmpp.Protocol.Iq
-        @return: a ready to send IQ containing the result of the action
+        @return: an IQ containing the error if any, None if the job thread replies
         """
         try:
-            old_status  = self.entity.xmppstatus
-            old_show    = self.entity.xmppstatusshow
-            query_node  = iq.getTag("query")
-            path        = query_node.getTag("archipel").getAttr("path")
-            format      = query_node.getTag("archipel").getAttr("format")
-            disk_path   = path.replace(path.split(".")[-1], "") + format
-            if os.path.exists(disk_path):
-                raise Exception("The disk with same name and extension already exists.")
-            self.entity.change_presence(presence_show="dnd", presence_status="Converting a disk...")
-            ret = subprocess.call([self.qemu_img_bin, "convert", path, "-O", format, disk_path])
-            if not ret == 0:
-                raise Exception("DriveError", "Unable to convert drive. Error code is " + str(ret))
-            os.unlink(path)
-            for drive in self.entity.definition.getTag("devices").getTags("disk"):
-                if drive.getTag("source"):
-                    if drive.getTag("source").getAttr("file") == path:
-                        if drive.getTag("driver"):
-                            drive.getTag("driver").setAttr("type", format)
-                        if drive.getTag("source"):
-                            drive.getTag("source").setAttr("file", disk_path)
-                        self.entity.define(self.entity.definition)
-                        break
-            self.entity.change_presence(presence_show=old_show, presence_status=old_status)
-            reply = iq.buildReply("result")
-            self.entity.log.info("Disk as been converted from %s to %s" % (path, disk_path))
-            self.entity.shout("disk", "I've just converted hard drive %s into format %s." % (path, format))
-            self.entity.push_change("disk", "converted")
+            archipel_node = iq.getTag("query").getTag("archipel")
+            path          = archipel_node.getAttr("path")
+            format        = archipel_node.getAttr("format")
+            disk_path     = path.replace(path.split(".")[-1], "") + format
+            self._reserve_paths([path], [disk_path])
+            thread.start_new_thread(self.perform_threaded_conversion, (iq, path, format, disk_path))
+            reply = None
         except Exception as ex:
-            self.entity.change_presence(presence_show=old_show, presence_status=old_status)
             reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_DRIVES_CONVERT)
         return reply
 
@@ -319,14 +852,15 @@ class TNStorageManagement (TNArchipelPlugin):
         @return: a ready to send IQ containing the result of the action
         """
         try:
-            query_node = iq.getTag("query")
-            path = query_node.getTag("archipel").getAttr("path")
-            newname = query_node.getTag("archipel").getAttr("newname").replace(" ", "_").replace("/", "_").replace("..", "_")
+            archipel_node = iq.getTag("query").getTag("archipel")
+            path = archipel_node.getAttr("path")
+            newname = ARCHIPEL_STORAGE_UNSAFE_NAME_REGEX.sub("_", archipel_node.getAttr("newname"))
             extension = path.split(".")[-1]
             newpath = os.path.join(self.entity.folder, "%s.%s" % (newname, extension))
             if os.path.exists(newpath):
                 raise Exception("The disk with name %s already exists." % newname)
             os.rename(path, newpath)
+            self._invalidate_folder(self.entity.folder)
             reply = iq.buildReply("result")
             self.entity.log.info("Renamed hard drive %s into  %s" % (path, newname))
             self.entity.shout("disk", "I've just renamed hard drive %s into  %s." % (path, newname))
@@ -337,41 +871,27 @@ class TNStorageManagement (TNArchipelPlugin):
 
     def iq_delete(self, iq):
         """
-        Delete a virtual hard drive.
+        Delete a virtual hard drive. Several drives can be deleted at
+        once by giving one <disk> child per drive to the archipel node.
         @type iq: xmpp.Protocol.Iq
         @param iq: the received IQ
         @rtype: xmpp.Protocol.Iq
-        @return: a ready to send IQ containing the result of the action
+        @return: an IQ containing the error if any, None if the job thread replies
         """
         try:
-            query_node          = iq.getTag("query")
-            disk_name           = query_node.getTag("archipel").getAttr("name")
-            secure_disk_name    = disk_name.split("/")[-1]
-            secure_disk_path    = os.path.join(self.entity.folder, secure_disk_name)
-            old_status          = self.entity.xmppstatus
-            old_show            = self.entity.xmppstatusshow
-            self.entity.change_presence(presence_show="dnd", presence_status="Deleting a drive...")
-            os.unlink(secure_disk_path)
-            disk_nodes = []
-            if self.entity.definition:
-                devices_node = self.entity.definition.getTag('devices')
-                disk_nodes = devices_node.getTags('disk', attrs={'type': 'file'})
-            if query_node.getTag("archipel").getAttr("undefine") == "yes":
-                have_undefined_at_least_on_disk = False
-                for disk_node in disk_nodes:
-                    path = disk_node.getTag('source').getAttr('file')
-                    if path == secure_disk_path:
-                        devices_node.delChild(disk_node)
-                        have_undefined_at_least_on_disk = True
-                if have_undefined_at_least_on_disk:
-                    xml = str(self.entity.definition).replace('xmlns="http://www.gajim.org/xmlns/undeclared" ', '')
-                    self.entity.libvirt_connection.defineXML(xml)
-                    self.entity.push_change("virtualmachine:definition", "defined")
-            self.entity.change_presence(presence_show=old_show, presence_status=old_status)
-            reply = iq.buildReply("result")
-            self.entity.log.info("disk %s deleted" % secure_disk_path)
-            self.entity.push_change("disk", "deleted")
-            self.entity.shout("disk", "I've just deleted the hard drive named %s." % (disk_name))
+            archipel_node = iq.getTag("query").getTag("archipel")
+            deletions = []
+            for disk_node in archipel_node.getTags("disk") or [archipel_node]:
+                disk_name           = disk_node.getAttr("name")
+                secure_disk_name    = disk_name.split("/")[-1]
+                secure_disk_path    = os.path.join(self.entity.folder, secure_disk_name)
+                if not os.path.isfile(secure_disk_path):
+                    raise Exception("The disk with name %s doesn't exist." % secure_disk_name)
+                if not secure_disk_path in [path for path, name in deletions]:
+                    deletions.append((secure_disk_path, disk_name))
+            undefine = archipel_node.getAttr("undefine") == "yes"
+            thread.start_new_thread(self.perform_threaded_deletion, (iq, deletions, undefine))
+            reply = None
         except Exception as ex:
             reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_DRIVES_DELETE)
         return reply
@@ -385,22 +905,9 @@ class TNStorageManagement (TNArchipelPlugin):
         @return: a ready to send IQ containing the result of the action
         """
         try:
-            disks = os.listdir(self.entity.folder)
             nodes = []
-            for disk in disks:
-                if self._is_file_a_drive(os.path.join(self.entity.folder, disk)):
-                    diskPath = os.path.join(self.entity.folder, disk)
-                    diskSize = os.path.getsize(diskPath)
-                    diskInfo = subprocess.Popen([self.qemu_img_bin, "info", diskPath], stdout=subprocess.PIPE).communicate()[0].split("\n")
-                    currentAttributes = {
-                        "name": os.path.basename(os.path.splitext(disk)[0]),
-                        "path": diskPath,
-                        "format": diskInfo[1].split(": ")[1],
-                        "virtualSize": diskInfo[2].split(" ")[3].replace("(", ""),
-                        "diskSize": diskSize
-                    }
-                    if len(diskInfo) == 7:
-                        currentAttributes["backingFile"] = os.path.basename(diskInfo[5].split()[2])
+            for currentAttributes in self._probe_folders([self.entity.folder], self._probe_drive, self._disk_cache):
+                if currentAttributes:
                     node = xmpp.Node(tag="disk", attrs=currentAttributes)
                     nodes.append(node)
             reply = iq.buildReply("result")
@@ -420,15 +927,9 @@ class TNStorageManagement (TNArchipelPlugin):
         """
         try:
             nodes = []
-            isos = os.listdir(self.entity.folder)
-            for iso in isos:
-                if self._is_file_an_iso(os.path.join(self.entity.folder, iso)):
-                    node = xmpp.Node(tag="iso", attrs={"name": iso, "path": os.path.join(self.entity.folder, iso)})
-                    nodes.append(node)
-            sharedisos = os.listdir(self.shared_isos_folder)
-            for iso in sharedisos:
-                if self._is_file_an_iso(os.path.join(self.shared_isos_folder, iso)):
-                    node = xmpp.Node(tag="iso", attrs={"name": iso, "path": os.path.join(self.shared_isos_folder, iso)})
+            for isoAttributes in self._probe_folders([self.entity.folder, self.shared_isos_folder], self._probe_iso, self._iso_cache):
+                if isoAttributes:
+                    node = xmpp.Node(tag="iso", attrs=isoAttributes)
                     nodes.append(node)
             reply = iq.buildReply("result")
             reply.setQueryPayload(nodes)
@@ -447,11 +948,9 @@ class TNStorageManagement (TNArchipelPlugin):
         """
         try:
             nodes = []
-            goldens = os.listdir(self.golden_drives_dir)
-            for golden in goldens:
-                if self._is_file_a_qcow(os.path.join(self.golden_drives_dir, golden)) \
-                or self._is_file_a_qcow2(os.path.join(self.golden_drives_dir, golden)):
-                    node = xmpp.Node(tag="golden", attrs={"name": golden, "path": os.path.join(self.golden_drives_dir, golden)})
+            for golden, goldenPath, goldenStat in self._list_files(self.golden_drives_dir):
+                if self._get_header_format(goldenPath) in ("qcow", "qcow2"):
+                    node = xmpp.Node(tag="golden", attrs={"name": golden, "path": goldenPath})
                     nodes.append(node)
             reply = iq.buildReply("result")
             reply.setQueryPayload(nodes)